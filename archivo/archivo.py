@@ -141,11 +141,7 @@ class Storage:
 
         # Restore metadata
         for rel_path, spec in iter_paths_and_specs(root_spec):
-            print(rel_path)
-            print(spec.meta)
             self._restore_metadata(spec.meta, dst_dir / rel_path)
-            print(os.stat(dst_dir / rel_path))
-            print()
 
         try:
             check_fulfils_spec(root_dst_path, root_spec)
@@ -5,6 +5,10 @@ from typing import (
     )
 
 from pathlib import Path
+import os
+import json
+import uuid
+import datetime
 
 PathLike = Union[Path, str]
 
@@ -18,9 +22,34 @@ def ensure_rel(path: PathLike) -> Path:
     return path
 
 def write_json_file(data, path):
-    with open(path, 'w') as f:
-        json.dump(data, f, indent=2)
-        f.write('\n')
+    # Written to a temporary file and renamed into place, so that the
+    # file at path is always complete, also after a crash
+    payload = (json.dumps(data, indent=2) + '\n').encode()
+    dir_path = os.path.dirname(os.path.abspath(path))
+    tmp_path = os.path.join(dir_path, f'.tmp-{uuid.uuid4().hex}')
+
+    # Created with mode 0o666 like open(path, 'w'), so that the umask
+    # applies as before
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    # Make the rename itself durable, where directories can be opened
+    try:
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
 
 def now_to_text():
     return datetime.datetime.utcnow().isoformat()
@@ -5,137 +5,499 @@
 from __future__ import annotations
 from pathlib import Path
 import os
+import stat
 import hashlib
+import operator
+import functools
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import (
     Union,
-    Sequence,
+    Dict,
     Generator,
     Tuple,
+    List,
+    Optional,
     )
 
 import attr
 
-from archivo import *
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
+from archivo import *
 
-_CHUNK_SIZE = 4096
 
-def get_file_hexdigest(path: PathLike, hash_name: str) -> str:
-    m = hashlib.new(hash_name)
+_CHUNK_SIZE = 1 << 20
+_BATCH_SIZE = 1 << 20
+_BATCH_LENGTH = 64
+_ADVISE_THRESHOLD = 1 << 20
+_MULTITHREAD_THRESHOLD = 64 << 20
+
+# Digests of already hashed files, see _get_cache_key. The least recently
+# used entries are dropped beyond _HEXDIGEST_CACHE_SIZE.
+_HEXDIGEST_CACHE = OrderedDict()
+_HEXDIGEST_CACHE_SIZE = 1 << 16
+
+# Even lookups reorder the cache, so it is only touched under this lock
+_HEXDIGEST_CACHE_LOCK = threading.Lock()
+
+# Some file systems keep timestamps at a coarse granularity (2 s on FAT),
+# so a file changed this shortly before it was hashed may be changed
+# again without changing its stat
+_RACY_WINDOW_NS = 2 * 10**9
+
+_thread_local = threading.local()
+
+def _new_blake3(multithreaded=False):
+    if multithreaded:
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return blake3.blake3()
+
+
+def _new_xxh3_128(multithreaded=False):
+    return xxhash.xxh3_128()
+
+
+# Fast non-cryptographic or SIMD-parallel hashes from optional packages,
+# as alternatives to the hashlib algorithms
+_HASH_BACKENDS = {}
+if blake3 is not None:
+    _HASH_BACKENDS['blake3'] = _new_blake3
+if xxhash is not None:
+    _HASH_BACKENDS['xxh3_128'] = _new_xxh3_128
+
+
+def _new_hash(hash_name: str, multithreaded=False):
+    # The digests only identify contents, so no FIPS restrictions apply
+    if hash_name in _HASH_BACKENDS:
+        return _HASH_BACKENDS[hash_name](multithreaded)
+    try:
+        return hashlib.new(hash_name, usedforsecurity=False)
+    except TypeError:  # usedforsecurity was added in Python 3.9
+        return hashlib.new(hash_name)
+
+
+def _advise_sequential(fd: int):
+    # Let the kernel start reading the whole file ahead of the hashing
+    # loop, with an enlarged readahead window. Together with the thread
+    # pool in read_spec this keeps many reads in flight on the device.
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+
+
+def _get_read_buffer() -> Tuple[bytearray, memoryview]:
+    # One buffer per thread, reused for every file that thread hashes
+    try:
+        return _thread_local.read_buffer
+    except AttributeError:
+        buf = bytearray(_CHUNK_SIZE)
+        _thread_local.read_buffer = buf, memoryview(buf)
+        return _thread_local.read_buffer
+
+
+def _sha_update(m, f):
+    # Reads into a preallocated buffer instead of allocating a new
+    # bytes object per chunk
+    buf, view = _get_read_buffer()
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        m.update(view[:n])
+
+
+def get_file_hexdigest(
+        path: PathLike,
+        hash_name: str,
+        size: Optional[int] = None,
+        ) -> str:
+    # size is the file size if already known from a stat, which saves an
+    # fstat here; it only picks how to read, not how much
     with open(path, 'rb') as f:
-        while True:
-            data = f.read(_CHUNK_SIZE)
-            if not data:
-                break
-            m.update(data)
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+
+        # Small files are read in one go anyway, so the advice would only
+        # cost syscalls
+        if size > _ADVISE_THRESHOLD:
+            _advise_sequential(f.fileno())
+
+        # Files are read rather than mapped: the sources are live user
+        # files, and a mapped file truncated while hashing raises SIGBUS
+        multithreaded = size > _MULTITHREAD_THRESHOLD
+        new_hash = functools.partial(
+            _new_hash, hash_name, multithreaded=multithreaded)
+
+        # hashlib.file_digest (Python 3.11+) runs the read/update loop in C
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, new_hash).hexdigest()
+
+        m = new_hash()
+        _sha_update(m, f)
     return m.hexdigest()
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True, frozen=True)
 class FileMeta:
     mode: int
     mtime_ns: int
     size: int
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True, frozen=True)
 class FileSpec:
     name: str
     hash_name: str
     hexdigest: str
     meta: FileMeta
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True, frozen=True)
 class DirMeta:
     mode: int
     mtime_ns: int
 
-@attr.s(auto_attribs=True)
+@attr.s(auto_attribs=True, slots=True, frozen=True)
 class DirSpec:
     name: str
-    contents: Sequence[FileOrDirSpec]
+    contents: Dict[str, FileOrDirSpec]
     meta: DirMeta
 
 FileOrDirSpec = Union[FileSpec, DirSpec]
 
-def _iter_paths_and_specs(spec, subdir, **kwargs):
-    this_path = ensure_rel(subdir / spec.name)
-    if isinstance(spec, FileSpec):
-        if kwargs['files']:
-            yield (this_path, spec)
-    else:
-        if kwargs['dirs']:
-            yield (this_path, spec)
-        for child in spec.contents:
-            yield from _iter_paths_and_specs(child, this_path, **kwargs)
-
-
 def iter_paths_and_specs(
     spec: FileOrDirSpec,
     dirs=True,
     files=True,
     ) -> Generator[Tuple[RelPath, FileSpec]]:
-    start_dir = Path('.')
-    return _iter_paths_and_specs(spec, start_dir, dirs=dirs, files=files)
-
-
-def read_meta(path: PathLike) -> Union[FileMeta, DirMeta]:
-    path = Path(path).resolve()
+    for this_path, spec in _walk_specs(spec, Path('.'), operator.truediv):
+        wanted = files if isinstance(spec, FileSpec) else dirs
+        if wanted:
+            yield (this_path, spec)
 
-    stat_result = os.stat(path)
 
-    if path.is_file():
+def _check_name(name: str):
+    # A name must be a single path component, so that joining it to its
+    # parent can never point outside the parent
+    invalid = (
+        name in ('', '.', '..')
+        or os.sep in name
+        or (os.altsep is not None and os.altsep in name)
+        or os.path.isabs(name)
+        )
+    if invalid:
+        raise ValueError(f'invalid name {name!r} in spec')
+
+
+def _walk_specs(spec, root, join):
+    # Iterative depth-first walk; children are pushed in reverse so that
+    # they are yielded in order, directories before their contents. With
+    # a str root and os.path.join, hot loops avoid building Path objects.
+    stack = deque([(spec, root)])
+    while stack:
+        spec, subdir = stack.pop()
+        _check_name(spec.name)
+        this_path = join(subdir, spec.name)
+        yield (this_path, spec)
+        if not isinstance(spec, FileSpec):
+            children = list(spec.contents.values())
+            stack.extend((child, this_path) for child in reversed(children))
+
+
+def _meta_from_stat(
+    stat_result: os.stat_result,
+    ) -> Union[FileMeta, DirMeta]:
+    if stat.S_ISREG(stat_result.st_mode):
         return FileMeta(
             mtime_ns=stat_result.st_mtime_ns,
             mode=stat_result.st_mode,
             size=stat_result.st_size,
             )
-    elif path.is_dir():
+    elif stat.S_ISDIR(stat_result.st_mode):
         return DirMeta(
             mtime_ns=stat_result.st_mtime_ns,
             mode=stat_result.st_mode,
             )
 
 
+def read_meta(path: PathLike) -> Union[FileMeta, DirMeta]:
+    return _meta_from_stat(os.stat(path))
+
+
 def get_apparent_name(path: Path) -> str:
     # Doing path.resolve() on a symlink would give the name of what
     # the symlink points to, but we want the name of the symlink
     # to represent the file or directory of what the symlink points to.
-    if path.is_symlink():
-        return path.name
+    # That is simply the last path component, so no syscall is needed.
+    name = path.name
 
-    # For concrete files and directories (including '.', and '..' etc)
-    # we get the right name by doing path.resolve()
-    else:
+    # Only for '.', '..' and the like (which pathlib shows as names ''
+    # and '..') we need path.resolve() to get the right name
+    if name in ('', '..'):
         return path.resolve().name
-
-
-def read_spec(path: PathLike, hash_name: str) -> FileOrDirSpec:
-    path = Path(path)
-    # Doing stat first of all to get it before any possible modification
-    # by following operations
-    meta = read_meta(path)
-
-    if path.is_dir():
+    else:
+        return name
+
+
+def _make_node(
+    path: PathLike,
+    name: str,
+    stat_result: os.stat_result,
+    files: List[Tuple[PathLike, os.stat_result]],
+    pending_dirs: List[Tuple[PathLike, list]],
+    ) -> Tuple[type, dict]:
+    # The stat result is taken by the caller first of all to get it before
+    # any possible modification by following operations. The same stat
+    # result decides the type, so each path is only stat'ed once.
+    meta = _meta_from_stat(stat_result)
+
+    if stat.S_ISDIR(stat_result.st_mode):
         type_ = DirSpec
-    elif path.is_file():
+    elif stat.S_ISREG(stat_result.st_mode):
         type_ = FileSpec
     else:
         raise ValueError(f'path {path} has unsupported type')
 
     kwargs = {}
-    kwargs['name'] = get_apparent_name(path)
+    kwargs['name'] = name
     kwargs['meta'] = meta
 
     if type_ == FileSpec:
-        kwargs['hexdigest'] = get_file_hexdigest(path, hash_name)
-        kwargs['hash_name'] = hash_name
+        # The digest is filled in by _build_spec once all files are hashed
+        kwargs['file_index'] = len(files)
+        files.append((path, stat_result))
 
     if type_ == DirSpec:
-        kwargs['contents'] = [
-            read_spec(child, hash_name)
-            for child in path.iterdir()
-            ]
+        # The contents are filled in when the directory is scanned
+        kwargs['contents'] = []
+        pending_dirs.append((path, kwargs['contents']))
+
+    return type_, kwargs
+
+
+def _scan_spec(
+    path: PathLike,
+    name: str,
+    stat_result: os.stat_result,
+    files: List[Tuple[PathLike, os.stat_result]],
+    ) -> Tuple[type, dict]:
+    pending_dirs = []
+    root_node = _make_node(path, name, stat_result, files, pending_dirs)
+
+    # Iterative walk over the directories still to be scanned, each with
+    # the list to put its child nodes in
+    while pending_dirs:
+        dir_path, contents = pending_dirs.pop()
+
+        # Directory entries carry their own name, which for symlinks is
+        # the apparent name, and cache their stat result
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                contents.append(_make_node(
+                    entry.path, entry.name, entry.stat(), files, pending_dirs))
+
+    return root_node
+
+
+def _build_file_spec(kwargs, hash_name, hexdigests, file_specs) -> FileSpec:
+    file_index = kwargs.pop('file_index')
+    kwargs['hexdigest'] = hexdigests[file_index]
+    kwargs['hash_name'] = hash_name
+    file_spec = FileSpec(**kwargs)
+    file_specs[file_index] = file_spec
+    return file_spec
+
+
+def _build_spec(node, hash_name, hexdigests, file_specs) -> FileOrDirSpec:
+    # Built file specs are also put in file_specs, in the order of the
+    # files list from the scan
+    type_, kwargs = node
+    if type_ == FileSpec:
+        return _build_file_spec(kwargs, hash_name, hexdigests, file_specs)
+
+    # Directories are collected top-down and built in reverse, so that
+    # each is built after all its children, without recursion
+    dir_kwargs = []
+    stack = [kwargs]
+    while stack:
+        kwargs = stack.pop()
+        dir_kwargs.append(kwargs)
+        stack.extend(
+            child_kwargs
+            for child_type, child_kwargs in kwargs['contents']
+            if child_type == DirSpec
+            )
+
+    # Built directories by id() of their kwargs, until their parent is
+    built_dirs = {}
+    for kwargs in reversed(dir_kwargs):
+        contents = {}
+        for child_type, child_kwargs in kwargs['contents']:
+            if child_type == FileSpec:
+                child = _build_file_spec(
+                    child_kwargs, hash_name, hexdigests, file_specs)
+            else:
+                child = built_dirs.pop(id(child_kwargs))
+            contents[child.name] = child
+        kwargs['contents'] = contents
+        built_dirs[id(kwargs)] = DirSpec(**kwargs)
+
+    return built_dirs.pop(id(dir_kwargs[0]))
+
+
+def _batch_files(
+    files: List[Tuple[PathLike, os.stat_result]],
+    ) -> List[List[Tuple[PathLike, int]]]:
+    # Small files are grouped so that each batch holds about _BATCH_SIZE
+    # bytes, amortizing the per-task overhead of the thread pool. At most
+    # _BATCH_LENGTH files go in one batch, since opening a file costs
+    # something even when it is empty.
+    batches = []
+    batch = []
+    batch_size = 0
+    for path, stat_result in files:
+        batch.append((path, stat_result.st_size))
+        batch_size += stat_result.st_size
+        if batch_size >= _BATCH_SIZE or len(batch) >= _BATCH_LENGTH:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _get_cpu_count() -> int:
+    # The CPUs this process may run on, which is fewer than os.cpu_count()
+    # under affinity masks or in containers
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _hash_batch(
+        batch: List[Tuple[PathLike, int]],
+        hash_name: str,
+        ) -> List[str]:
+    return [
+        get_file_hexdigest(path, hash_name, size)
+        for path, size in batch
+        ]
+
+
+def _get_cache_key(stat_result: os.stat_result, hash_name: str) -> tuple:
+    # Any write to the file changes its mtime and ctime, and ctime cannot
+    # be set back by the user, so an unchanged key means unchanged content
+    return (
+        hash_name,
+        stat_result.st_dev,
+        stat_result.st_ino,
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+        stat_result.st_ctime_ns,
+        )
+
+
+def _time_ns() -> int:
+    if hasattr(time, 'time_ns'):  # Added in Python 3.7
+        return time.time_ns()
+    return int(time.time() * 10**9)
+
+
+def _is_racy(stat_result: os.stat_result, hashed_at_ns: int) -> bool:
+    # Like git's racy clean entries: only a file last changed well before
+    # it was hashed can be trusted to be unchanged while its key is
+    changed_ns = max(stat_result.st_mtime_ns, stat_result.st_ctime_ns)
+    return changed_ns >= hashed_at_ns - _RACY_WINDOW_NS
+
+
+def _get_cached_hexdigest(key: tuple) -> Optional[str]:
+    with _HEXDIGEST_CACHE_LOCK:
+        hexdigest = _HEXDIGEST_CACHE.get(key)
+        if hexdigest is not None:
+            _HEXDIGEST_CACHE.move_to_end(key)
+    return hexdigest
+
+
+def _cache_hexdigest(key: tuple, hexdigest: str):
+    with _HEXDIGEST_CACHE_LOCK:
+        _HEXDIGEST_CACHE[key] = hexdigest
+        if len(_HEXDIGEST_CACHE) > _HEXDIGEST_CACHE_SIZE:
+            _HEXDIGEST_CACHE.popitem(last=False)
+
+
+def _hash_files(
+    files: List[Tuple[PathLike, os.stat_result]],
+    hash_name: str,
+    max_workers: Optional[int],
+    use_cache: bool = True,
+    ) -> List[str]:
+    # Verification passes use_cache=False, to read every byte again
+    keys = [_get_cache_key(stat_result, hash_name) for _, stat_result in files]
+    if use_cache:
+        hexdigests = [_get_cached_hexdigest(key) for key in keys]
+    else:
+        hexdigests = [None] * len(files)
+    missing = [i for i, d in enumerate(hexdigests) if d is None]
+
+    # Taken before any file is read, to tell which digests can be cached
+    hashed_at_ns = _time_ns()
+
+    # hashlib releases the GIL while hashing, so files are hashed
+    # concurrently in threads
+    hash_batch = functools.partial(_hash_batch, hash_name=hash_name)
+    batches = _batch_files([files[i] for i in missing])
+    if len(batches) > 1:
+        if max_workers is None:
+            max_workers = _get_cpu_count()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(hash_batch, batches)
+            computed = [d for result in results for d in result]
+    else:
+        computed = [d for batch in batches for d in hash_batch(batch)]
+
+    for i, hexdigest in zip(missing, computed):
+        hexdigests[i] = hexdigest
+        _, stat_result = files[i]
+        if use_cache and not _is_racy(stat_result, hashed_at_ns):
+            _cache_hexdigest(keys[i], hexdigest)
+
+    return hexdigests
+
+
+def read_spec_with_files(
+    path: PathLike,
+    hash_name: str,
+    max_workers: Optional[int] = None,
+    ) -> Tuple[FileOrDirSpec, List[Tuple[PathLike, FileSpec]]]:
+    # Like read_spec, but also returns the path of each file found next
+    # to its spec, so callers need not walk the spec to find the files
+    files = []
+    path = Path(path)
+    root_node = _scan_spec(
+        path, get_apparent_name(path), os.stat(path), files)
+    hexdigests = _hash_files(files, hash_name, max_workers)
+    file_specs = [None] * len(files)
+    spec = _build_spec(root_node, hash_name, hexdigests, file_specs)
+    file_paths = (file_path for file_path, _ in files)
+    return spec, list(zip(file_paths, file_specs))
 
-    return type_(**kwargs)
+
+def read_spec(
+    path: PathLike,
+    hash_name: str,
+    max_workers: Optional[int] = None,
+    ) -> FileOrDirSpec:
+    spec, _ = read_spec_with_files(path, hash_name, max_workers)
+    return spec
 
 
 class DifferentSpec(Exception):
@@ -148,19 +510,29 @@ class DifferentSpec(Exception):
         return self.message
 
 
-def check_fulfils_spec(path: PathLike, root_spec: FileOrDirSpec):
+def check_fulfils_spec(
+    path: PathLike,
+    root_spec: FileOrDirSpec,
+    check_digests: bool = True,
+    ):
+    path = Path(path)
     if path.is_symlink():
         raise ValueError(f'cannot check symlink {path}')
 
-    path = Path(path).resolve()
+    path = path.resolve()
     containing_dir = path.parent
 
+    # Files to hash, grouped by hash name
+    files = {}
+
     # For all dirs and files...
     for rel_path, spec in iter_paths_and_specs(root_spec):
 
-        # Check that they exist
+        # Check that they exist; the same stat gives the metadata
         abs_path = containing_dir / rel_path
-        if not abs_path.exists():
+        try:
+            stat_result = os.stat(abs_path)
+        except FileNotFoundError:
             raise DifferentSpec(
                 message=f'subpath {rel_path} does not exist',
                 expected_spec=spec,
@@ -168,7 +540,7 @@ def check_fulfils_spec(path: PathLike, root_spec: FileOrDirSpec):
                 )
 
         # Check that they have the right metadata
-        meta = read_meta(abs_path)
+        meta = _meta_from_stat(stat_result)
         if meta != spec.meta:
             raise DifferentSpec(
                 message=(
@@ -179,18 +551,28 @@ def check_fulfils_spec(path: PathLike, root_spec: FileOrDirSpec):
                 target_info={'path': abs_path, 'meta': meta},
                 )
 
-    # Then check that all files have the right spec (including content digest)
-    for rel_path, spec in iter_paths_and_specs(root_spec, dirs=False):
-        abs_path = containing_dir / rel_path
-        assert abs_path.is_file()
-
-        target_spec = read_spec(abs_path, spec.hash_name)
-        if target_spec != spec:
-            raise DifferentSpec(
-                message=(
-                    f'file spec at {rel_path} does not match: '
-                    f'expected {spec} but found {target_spec}'
-                    ),
-                expected_spec=spec,
-                target_info={'path': rel_path, 'spec': target_spec}
-                )
\ No newline at end of file
+        if check_digests and isinstance(spec, FileSpec):
+            files.setdefault(spec.hash_name, []).append(
+                (abs_path, stat_result, rel_path, spec))
+
+    # Then check that all files have the right content digest. Names and
+    # metadata are already checked, so the digest is all that can differ.
+    for hash_name, group in files.items():
+        hexdigests = _hash_files(
+            [(abs_path, stat_result) for abs_path, stat_result, _, _ in group],
+            hash_name,
+            max_workers=None,
+            use_cache=False,
+            )
+        for (abs_path, stat_result, rel_path, spec), hexdigest in zip(
+                group, hexdigests):
+            if hexdigest != spec.hexdigest:
+                target_spec = attr.evolve(spec, hexdigest=hexdigest)
+                raise DifferentSpec(
+                    message=(
+                        f'file spec at {rel_path} does not match: '
+                        f'expected {spec} but found {target_spec}'
+                        ),
+                    expected_spec=spec,
+                    target_info={'path': rel_path, 'spec': target_spec}
+                    )
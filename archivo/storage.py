@@ -3,21 +3,39 @@
 from __future__ import annotations
 from pathlib import Path
 import os
+import sys
 import json
+import errno
 import shutil
+import ctypes
 import tempfile
+import uuid
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from typing import (
     Union,
+    Dict,
+    List,
+    Tuple,
+    Optional,
+    Set,
     )
 
 import attr
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 from archivo import *
 from archivo.specs import (
-    iter_paths_and_specs,
-    get_apparent_name,
-    read_spec,
+    DirSpec,
+    _walk_specs,
+    _get_cpu_count,
+    read_spec_with_files,
+    read_meta,
+    FileMeta,
     DifferentSpec,
     check_fulfils_spec,
     )
@@ -29,27 +47,254 @@ class CollisionError(Exception):
 class RestoreError(Exception):
     pass
 
+class StoreError(Exception):
+    pass
+
+class UnsupportedStorageError(Exception):
+    pass
+
+
+# Storage layouts, recorded as 'layout' in .archivo-storage. Storages
+# from before the field keep files directly in the hash directory.
+_FLAT_LAYOUT = 1
+_SHARDED_LAYOUT = 2
+
+# os.chmod and os.utime take file descriptors on POSIX, but on Windows
+# only from Python 3.13
+_SET_META_BY_FD = (
+    os.chmod in os.supports_fd and os.utime in os.supports_fd)
+
+# ioctl request number of FICLONE (reflink a whole file) from linux/fs.h
+_FICLONE = 0x40049409
+
+_COPY_RANGE_SIZE = 1 << 30
+_COPY_BUFFER_SIZE = 1 << 20
+
+# Number of files above which Storage.store lists the whole storage
+_INDEX_THRESHOLD = 1024
+
+# Errors meaning that a copy method is not supported for these files
+_UNSUPPORTED_COPY_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.EPERM,
+    }
+
+
+# Errors meaning that a file cannot be hard-linked to the given path
+_UNSUPPORTED_LINK_ERRNOS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EACCES,
+    errno.EMLINK,
+    errno.EOPNOTSUPP,
+    }
 
-def _copy_into(src_path: Path, dst_dir: Path) -> Path:
-    name = get_apparent_name(src_path)
-    dst_path = dst_dir / name
 
-    if src_path.is_dir():
-        shutil.copytree(src_path, dst_path)
-    elif src_path.is_file():
-        shutil.copy2(src_path, dst_path)
+def _copy_in_kernel(src_fd: int, dst_fd: int) -> bool:
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+                raise
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while os.copy_file_range(src_fd, dst_fd, _COPY_RANGE_SIZE):
+                pass
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+                raise
+
+    # Only Linux can sendfile between regular files
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        try:
+            while os.sendfile(dst_fd, src_fd, None, _COPY_RANGE_SIZE):
+                pass
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+                raise
+
+    return False
+
+
+def _copy_in_user_space(src, dst):
+    # readinto one buffer instead of allocating a bytes object per chunk
+    buf = bytearray(_COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        dst.write(view[:n])
+
+
+def _fast_copyfile(
+        src_path: PathLike,
+        dst_path: PathLike,
+        meta: Optional[FileMeta] = None,
+        ) -> PathLike:
+    # Like shutil.copyfile, but first tries a copy-on-write clone (FICLONE)
+    # and then in-kernel copies (copy_file_range, sendfile) before falling
+    # back to copying the bytes through user space. The kernel copies
+    # leave both file offsets where they stopped, so each fallback
+    # continues from there.
+    with open(src_path, 'rb', buffering=0) as src, \
+            open(dst_path, 'wb', buffering=0) as dst:
+        if not _copy_in_kernel(src.fileno(), dst.fileno()):
+            _copy_in_user_space(src, dst)
+
+        # Setting metadata through the open descriptor saves resolving
+        # the path again for each call
+        if meta is not None and _SET_META_BY_FD:
+            set_mode(dst.fileno(), meta.mode)
+            set_mtime_ns(dst.fileno(), meta.mtime_ns)
+
+    if meta is not None and not _SET_META_BY_FD:
+        set_mode(dst_path, meta.mode)
+        set_mtime_ns(dst_path, meta.mtime_ns)
+    return dst_path
+
+
+def _copy_files(copies: List[Tuple[PathLike, PathLike, FileMeta]]):
+    # The copies are independent and spend their time in the kernel with
+    # the GIL released, so they run in threads unless disabled with
+    # ARCHIVO_PARALLEL_COPY=0 (e.g. for spinning disks)
+    parallel = os.environ.get('ARCHIVO_PARALLEL_COPY', '1') != '0'
+    if parallel and len(copies) > 1:
+        max_workers = min(32, _get_cpu_count() * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list() to raise any error from the copies
+            list(executor.map(lambda copy: _fast_copyfile(*copy), copies))
     else:
-        raise ValueError(f'path {src_path} is of unsupported type')
+        for src_path, dst_path, meta in copies:
+            _fast_copyfile(src_path, dst_path, meta)
 
+
+def _fast_copy(src_path: PathLike, dst_path: PathLike) -> PathLike:
+    # Like shutil.copy2
+    _fast_copyfile(src_path, dst_path)
+    shutil.copystat(src_path, dst_path)
     return dst_path
 
 
+def _move_into_place(src_path: PathLike, dst_path: PathLike) -> bool:
+    # Like os.rename, but falls back to copying when a mount (such as a
+    # bind mount) puts the two paths on different file systems. The copy
+    # is made beside dst_path and renamed there, so the move stays
+    # atomic. Returns whether a copy was made, in which case the source
+    # is left for the caller to remove.
+    try:
+        os.rename(src_path, dst_path)
+        return False
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    tmp_path = f'{os.fspath(dst_path)}.{uuid.uuid4().hex}.tmp'
+    try:
+        if os.path.isdir(src_path):
+            shutil.copytree(src_path, tmp_path, copy_function=_fast_copy)
+        else:
+            _fast_copy(src_path, tmp_path)
+        os.rename(tmp_path, dst_path)
+    except BaseException:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+# Constants for utimensat(2) from linux/fcntl.h and linux/stat.h
+_AT_FDCWD = -100
+_UTIME_OMIT = (1 << 30) - 2
+
+
+def _load_libc_function(name, argtypes):
+    # os.utime cannot leave atime untouched, but utimensat(2) and
+    # futimens(3) can
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        function = getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_int
+    return function
+
+_utimensat = _load_libc_function('utimensat', [
+    ctypes.c_int,
+    ctypes.c_char_p,
+    ctypes.POINTER(_Timespec),
+    ctypes.c_int,
+    ])
+_futimens = _load_libc_function('futimens', [
+    ctypes.c_int,
+    ctypes.POINTER(_Timespec),
+    ])
+
+
 def set_mode(path, mode):
+    # path may also be a file descriptor
     os.chmod(path, mode)
 
 def set_mtime_ns(path, mtime_ns):
-    atime_ns = os.stat(path).st_atime_ns
-    os.utime(path, ns=(atime_ns, mtime_ns))
+    # path may also be a file descriptor
+    is_fd = isinstance(path, int)
+    times = (_Timespec * 2)(
+        _Timespec(0, _UTIME_OMIT),
+        _Timespec(*divmod(mtime_ns, 10**9)),
+        )
+    if is_fd and _futimens is not None:
+        result = _futimens(path, times)
+    elif not is_fd and _utimensat is not None:
+        result = _utimensat(_AT_FDCWD, os.fsencode(path), times, 0)
+    else:
+        atime_ns = os.stat(path).st_atime_ns
+        os.utime(path, ns=(atime_ns, mtime_ns))
+        return
+
+    if result != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), str(path))
+
+
+# Parsed .archivo-storage files, see _read_storage_meta
+_META_CACHE = {}
+
+
+def _read_storage_meta(meta_path: Path) -> Dict[str, Union[int, str]]:
+    # Rewriting the file changes its inode or mtime, so a cached parse is
+    # used only while the key is unchanged
+    stat_result = os.stat(meta_path)
+    key = (
+        str(meta_path),
+        stat_result.st_ino,
+        stat_result.st_mtime_ns,
+        stat_result.st_size,
+        )
+    meta = _META_CACHE.get(key)
+    if meta is None:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        _META_CACHE[key] = meta
+
+    # A copy, so that no instance can modify the cached dict
+    return dict(meta)
 
 
 @attr.s(auto_attribs=True)
@@ -57,14 +302,42 @@ class Storage:
     path: Path = attr.ib(converter=ensure_abs)
     meta: Dict[str, Union[int, str]] = attr.ib(init=False, repr=False)
     hash_name: str = attr.ib(init=False, repr=False)
-
-    def _get_storage_path(self, file_spec):
-        return self.path / f'{file_spec.hash_name}/{file_spec.hexdigest}'
+    # Caches and values derived from the above, which take no part in
+    # comparisons
+    _hexdigests: Optional[Set[str]] = attr.ib(
+        init=False, default=None, repr=False, eq=False)
+    _hash_dir: str = attr.ib(init=False, repr=False, eq=False)
+    _staging_dir: str = attr.ib(init=False, repr=False, eq=False)
+    _has_staging_dir: bool = attr.ib(
+        init=False, default=False, repr=False, eq=False)
+    _sharded: bool = attr.ib(init=False, repr=False, eq=False)
+
+    def _get_storage_path(self, file_spec) -> str:
+        # Files are sharded on the first two hex digits of their digest,
+        # like git objects, to keep directories small; flat storages keep
+        # them directly in the hash directory. The path is
+        # returned as a str; it is only ever passed to os functions.
+        hexdigest = file_spec.hexdigest
+        if file_spec.hash_name == self.hash_name:
+            hash_dir = self._hash_dir
+        else:
+            hash_dir = os.path.join(self.path, file_spec.hash_name)
+        if self._sharded:
+            return os.path.join(hash_dir, hexdigest[:2], hexdigest)
+        return os.path.join(hash_dir, hexdigest)
 
     def __attrs_post_init__(self):
-        with open(Storage._get_meta_path(self.path), 'r') as f:
-            self.meta = json.load(f)
-            self.hash_name = self.meta['hash_name']
+        self.meta = _read_storage_meta(Storage._get_meta_path(self.path))
+        self.hash_name = self.meta['hash_name']
+        self._hash_dir = os.path.join(self.path, self.hash_name)
+        self._staging_dir = os.path.join(self.path, '.staging')
+
+        # Older storages are used in their flat layout, not migrated
+        layout = self.meta.get('layout', _FLAT_LAYOUT)
+        if layout not in (_FLAT_LAYOUT, _SHARDED_LAYOUT):
+            raise UnsupportedStorageError(
+                f'storage {self.path} has unknown layout {layout}')
+        self._sharded = layout == _SHARDED_LAYOUT
 
     @staticmethod
     def _get_meta_path(storage_path: Path) -> Path:
@@ -74,34 +347,138 @@ class Storage:
     def create(path: PathLike, hash_name=DEFAULT_HASH) -> Storage:
         path = ensure_abs(path)
         os.makedirs(path, exist_ok=False)
+
+        # Creating all shard directories up front means that storing a
+        # file never needs to create a directory
+        for shard in range(256):
+            os.makedirs(path / hash_name / f'{shard:02x}')
+
         metadata = {
             'created': now_to_text(),
             'hash_name': hash_name,
+            'layout': _SHARDED_LAYOUT,
         }
         write_json_file(metadata, Storage._get_meta_path(path))
         return Storage(path)
 
 
-    def has_file(self, file_spec: FileSpec) -> bool:
-        return self._get_storage_path(file_spec).exists()
+    def _get_staging_dir(self) -> str:
+        # Files and trees are staged in a long-lived directory inside the
+        # storage, so that the final renames stay on one file system. It
+        # is created on first use, also for storages made before it.
+        if not self._has_staging_dir:
+            os.makedirs(self._staging_dir, exist_ok=True)
+            self._has_staging_dir = True
+        return self._staging_dir
+
+    def _load_index(self):
+        # The names in the shard directories, or in the hash directory of
+        # a flat storage, are the stored digests. A flat storage only has
+        # a hash directory once something is stored.
+        hexdigests = set()
+        if self._sharded:
+            with os.scandir(self._hash_dir) as shards:
+                digest_dirs = [shard.path for shard in shards]
+        elif os.path.isdir(self._hash_dir):
+            digest_dirs = [self._hash_dir]
+        else:
+            digest_dirs = []
+        for digest_dir in digest_dirs:
+            with os.scandir(digest_dir) as entries:
+                hexdigests.update(entry.name for entry in entries)
+        self._hexdigests = hexdigests
 
+    def has_file(self, file_spec: FileSpec) -> bool:
+        # Files are never removed from storage, so a loaded index can at
+        # worst miss files added by others, which are then added again
+        indexed = (
+            self._hexdigests is not None
+            and file_spec.hash_name == self.hash_name
+            )
+        if indexed:
+            return file_spec.hexdigest in self._hexdigests
+        return os.path.lexists(self._get_storage_path(file_spec))
+
+
+    def _add_file(
+            self,
+            src_path: PathLike,
+            file_spec: FileSpec,
+            dst_path: PathLike,
+            link: bool = False,
+            ):
+        # The file is copied, as a copy-on-write clone where the file
+        # system supports it, or hard-linked if asked for; see store.
+        # Either way the file is staged and renamed into place, so that
+        # anything at a storage path is complete. The random suffix keeps
+        # concurrent writers of the same file apart.
+        tmp_path = os.path.join(
+            self._get_staging_dir(),
+            f'{file_spec.hexdigest}.{uuid.uuid4().hex}',
+            )
+        try:
+            linked = False
+            if link:
+                try:
+                    os.link(src_path, tmp_path)
+                    linked = True
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED_LINK_ERRNOS:
+                        raise
+            if not linked:
+                _fast_copy(src_path, tmp_path)
+
+            if read_meta(tmp_path) != file_spec.meta:
+                raise StoreError(
+                    f'file {src_path} was modified while storing')
 
-    def store(self, src_path: PathLike) -> FileOrDirSpec:
+            try:
+                copied = _move_into_place(tmp_path, dst_path)
+            except FileNotFoundError:
+                # Flat storages and other hash names than the storage's
+                # have no directories made up front
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                copied = _move_into_place(tmp_path, dst_path)
+            if copied:
+                os.unlink(tmp_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        if self._hexdigests is not None:
+            self._hexdigests.add(file_spec.hexdigest)
+
+    def store(self, src_path: PathLike, link: bool = False) -> FileOrDirSpec:
+        # With link=True, new files are hard-linked into storage instead
+        # of copied. The stored file is then the same file as the source,
+        # so any later edit or chmod of the source silently corrupts the
+        # storage. Only use it for sources that are never changed again.
         src_path = Path(src_path)
-        with tempfile.TemporaryDirectory(dir=self.path) as tmp_dir:
-            tmp_dir = Path(tmp_dir)
-            tmp_path = _copy_into(src_path, tmp_dir)
 
-            spec = read_spec(tmp_path, self.hash_name)
+        # Hash the source in place instead of copying it first, so that
+        # files which are already stored are only ever read
+        spec, files = read_spec_with_files(src_path, self.hash_name)
+
+        # For large trees, listing the storage once is cheaper than a
+        # lookup per file
+        if self._hexdigests is None and len(files) > _INDEX_THRESHOLD:
+            self._load_index()
+
+        # A source on another file system can never be hard-linked, so
+        # don't try for every file. Mounts inside the source tree still
+        # fall back per file.
+        if link:
+            link = os.stat(src_path).st_dev == os.stat(self.path).st_dev
 
-            for rel_path, file_spec in iter_paths_and_specs(spec, dirs=False):
-                if self.has_file(file_spec):
-                    continue
+        for file_path, file_spec in files:
+            if self.has_file(file_spec):
+                continue
 
-                tmp_path = tmp_dir / rel_path
-                dst_path = self._get_storage_path(file_spec)
-                os.makedirs(dst_path.parent, exist_ok=True)
-                os.rename(tmp_path, dst_path)
+            dst_path = self._get_storage_path(file_spec)
+            self._add_file(file_path, file_spec, dst_path, link)
 
         return spec
 
@@ -109,33 +486,80 @@ class Storage:
         set_mode(dst_path, meta.mode)
         set_mtime_ns(dst_path, meta.mtime_ns)
 
-    def _restore_into(self, root_spec, dst_dir):
-
-        root_dst_path = dst_dir / root_spec.name
-
-        # Create all the directories
-        for rel_path, dir_spec in iter_paths_and_specs(root_spec, files=False):
-            os.makedirs(dst_dir / rel_path, exist_ok=True)
+    def _link_stored_file(self, file_spec, dst_path) -> bool:
+        # A hard link shares the inode with the stored file, whose mode
+        # and mtime must never be changed. So a link is only made when
+        # the stored file already has the metadata of the spec.
+        src_path = self._get_storage_path(file_spec)
+        if read_meta(src_path) != file_spec.meta:
+            return False
+        try:
+            os.link(src_path, dst_path)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_LINK_ERRNOS:
+                raise
+            return False
+        return True
 
-        # Copy all the files
-        for rel_path, file_spec in iter_paths_and_specs(root_spec, dirs=False):
-            src_path = self._get_storage_path(file_spec)
-            shutil.copy2(src_path, dst_dir / rel_path)
+    def _restore_into(self, root_spec, dst_dir, verify, link):
 
-        # Restore metadata
-        for rel_path, spec in iter_paths_and_specs(root_spec):
-            self._restore_metadata(spec.meta, dst_dir / rel_path)
+        root_dst_path = dst_dir / root_spec.name
 
+        # Create the directories and collect the file copies in a single
+        # top-down pass. Copied files get mode and mtime from the spec as
+        # part of the copy; directories get theirs afterward.
+        paths_and_specs = []
+        copies = []
+        # The walk checks every name before joining it, so os.path.join
+        # can never be handed an absolute name that discards dst_dir
+        walk = _walk_specs(root_spec, os.fspath(dst_dir), os.path.join)
+        for dst_path, spec in walk:
+            if isinstance(spec, DirSpec):
+                # Parents come before their contents, so a plain mkdir
+                # is enough
+                os.mkdir(dst_path)
+            elif link and self._link_stored_file(spec, dst_path):
+                # Metadata is already right, and must not be touched
+                continue
+            else:
+                copies.append(
+                    (self._get_storage_path(spec), dst_path, spec.meta))
+                continue
+            paths_and_specs.append((dst_path, spec))
+
+        _copy_files(copies)
+
+        # Restore metadata bottom-up, so no directory is modified after
+        # its mtime is set
+        for dst_path, spec in reversed(paths_and_specs):
+            self._restore_metadata(spec.meta, dst_path)
+
+        # The files were just copied from storage, so checking existence
+        # and metadata is enough unless verification is asked for
         try:
-            check_fulfils_spec(root_dst_path, root_spec)
+            check_fulfils_spec(root_dst_path, root_spec, check_digests=verify)
         except DifferentSpec as e:
             raise RestoreError('Could not restore') from e
 
-    def restore(self, spec: FileOrDirSpec, dst_dir: PathLike) -> None:
+    def restore(
+            self,
+            spec: FileOrDirSpec,
+            dst_dir: PathLike,
+            verify: bool = True,
+            link: bool = False,
+            ) -> None:
+        # With link=True, files are hard-linked from storage where their
+        # metadata allows it. The restored files are then the stored
+        # files, so editing them in place corrupts the storage.
         dst_dir = Path(dst_dir)
         dst_path = dst_dir / spec.name
 
-        if dst_path.exists():
+        # A symlink, even a dangling one, is never what a spec describes;
+        # check_fulfils_spec refuses to follow it
+        if os.path.islink(dst_path):
+            raise CollisionError(f'Symlink at {dst_path}')
+
+        if os.path.lexists(dst_path):
             try:
                 check_fulfils_spec(dst_path, spec)
             except DifferentSpec as e:
@@ -144,8 +568,10 @@ class Storage:
             # All fine; no restore needed
             return
 
-        with tempfile.TemporaryDirectory(dir=self.path) as tmp_dir:
+        staging_dir = self._get_staging_dir()
+        with tempfile.TemporaryDirectory(dir=staging_dir) as tmp_dir:
             tmp_dir = Path(tmp_dir)
             tmp_path = tmp_dir / spec.name
-            self._restore_into(spec, tmp_dir)
-            os.rename(tmp_path, dst_path)
+            self._restore_into(spec, tmp_dir, verify, link)
+            # A copied tree is removed along with tmp_dir
+            _move_into_place(tmp_path, dst_path)
@@ -16,6 +16,11 @@ requirements = [
     'attrs>=19.1.0',
     ]
 
+extra_requirements = {
+    'blake3': ['blake3'],
+    'xxhash': ['xxhash'],
+    }
+
 setup_requirements = ['pytest-runner', ]
 
 test_requirements = ['pytest', ]
@@ -37,6 +42,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `archivo.core`."""
+
+import os
+import json
+import stat
+
+import pytest
+
+from archivo.core import write_json_file
+
+
+@pytest.fixture
+def umask():
+    old_umask = os.umask(0o022)
+    os.umask(old_umask)
+
+    def set_umask(mask):
+        os.umask(mask)
+
+    yield set_umask
+    os.umask(old_umask)
+
+
+@pytest.mark.parametrize('mask, mode', [(0o022, 0o644), (0o077, 0o600)])
+def test_write_json_file_respects_umask(tmp_path, umask, mask, mode):
+    umask(mask)
+    path = tmp_path / 'data.json'
+    write_json_file({'a': 1}, path)
+    assert json.loads(path.read_text()) == {'a': 1}
+    assert stat.S_IMODE(os.stat(path).st_mode) == mode
+
+
+def test_write_json_file_replaces_atomically(tmp_path, monkeypatch):
+    path = tmp_path / 'data.json'
+    write_json_file({'a': 1}, path)
+
+    def fail(fd):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(os, 'fsync', fail)
+    with pytest.raises(OSError):
+        write_json_file({'a': 2}, path)
+
+    # The old file is intact and no temporary file is left behind
+    assert json.loads(path.read_text()) == {'a': 1}
+    assert os.listdir(tmp_path) == ['data.json']
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `archivo.specs`."""
+
+import os
+import sys
+import hashlib
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+from archivo import specs
+from archivo.specs import (
+    DirSpec,
+    FileSpec,
+    DifferentSpec,
+    check_fulfils_spec,
+    get_file_hexdigest,
+    iter_paths_and_specs,
+    read_spec,
+    read_spec_with_files,
+    )
+
+
+@pytest.fixture
+def src_tree(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'a.txt').write_bytes(b'alpha')
+    (src / 'sub' / 'b.txt').write_bytes(b'beta')
+    return src
+
+
+def test_check_fulfils_spec_digests(src_tree):
+    spec = read_spec(src_tree, 'sha256')
+    check_fulfils_spec(src_tree, spec)
+
+    # Same size and mtime, so only the digest tells the difference
+    path = src_tree / 'a.txt'
+    stat_result = os.stat(path)
+    path.write_bytes(b'ALPHA')
+    os.utime(path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+
+    check_fulfils_spec(src_tree, spec, check_digests=False)
+    with pytest.raises(DifferentSpec):
+        check_fulfils_spec(src_tree, spec)
+
+
+def test_check_fulfils_spec_missing(src_tree):
+    spec = read_spec(src_tree, 'sha256')
+    os.unlink(src_tree / 'sub' / 'b.txt')
+    with pytest.raises(DifferentSpec):
+        check_fulfils_spec(src_tree, spec, check_digests=False)
+
+
+def test_check_fulfils_spec_refuses_symlink(src_tree, tmp_path):
+    spec = read_spec(src_tree, 'sha256')
+    os.symlink(src_tree, tmp_path / 'link')
+    with pytest.raises(ValueError):
+        check_fulfils_spec(tmp_path / 'link', spec)
+
+
+def test_read_spec_with_files(src_tree):
+    spec, files = read_spec_with_files(src_tree, 'sha256')
+    assert spec == read_spec(src_tree, 'sha256')
+
+    found = {
+        os.path.relpath(path, src_tree.parent): file_spec
+        for path, file_spec in files
+        }
+    expected = {
+        os.fspath(rel_path): file_spec
+        for rel_path, file_spec in iter_paths_and_specs(spec, dirs=False)
+        }
+    assert found == expected
+
+
+@pytest.mark.parametrize('hash_name, module_name', [
+    ('blake3', 'blake3'),
+    ('xxh3_128', 'xxhash'),
+    ])
+def test_optional_hash_backends(tmp_path, hash_name, module_name):
+    module = pytest.importorskip(module_name)
+    if hash_name == 'blake3':
+        expected = module.blake3(b'alpha').hexdigest()
+    else:
+        expected = module.xxh3_128(b'alpha').hexdigest()
+
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'alpha')
+    assert get_file_hexdigest(path, hash_name) == expected
+
+
+def test_read_spec(src_tree):
+    spec = read_spec(src_tree, 'sha256')
+    assert isinstance(spec, DirSpec)
+    assert set(spec.contents) == {'a.txt', 'sub'}
+
+    file_spec = spec.contents['a.txt']
+    assert isinstance(file_spec, FileSpec)
+    assert file_spec.hexdigest == hashlib.sha256(b'alpha').hexdigest()
+    assert file_spec.meta.size == 5
+
+
+@pytest.fixture
+def deep_tree(tmp_path):
+    # Deeper than the recursion limit, made and removed without any
+    # recursive helpers (os.makedirs and shutil.rmtree recurse)
+    depth = sys.getrecursionlimit() + 100
+    dir_paths = [os.fspath(tmp_path / 'deep')]
+    for _ in range(depth - 1):
+        dir_paths.append(os.path.join(dir_paths[-1], 'd'))
+    for dir_path in dir_paths:
+        os.mkdir(dir_path)
+    file_path = os.path.join(dir_paths[-1], 'f')
+    with open(file_path, 'wb') as f:
+        f.write(b'deep')
+
+    yield tmp_path / 'deep', depth
+
+    os.unlink(file_path)
+    for dir_path in reversed(dir_paths):
+        os.rmdir(dir_path)
+
+
+def test_read_spec_deep_tree(deep_tree):
+    path, depth = deep_tree
+    spec = read_spec(path, 'sha256')
+
+    n_dirs = 0
+    while isinstance(spec, DirSpec):
+        n_dirs += 1
+        (spec,) = spec.contents.values()
+    assert n_dirs == depth
+    assert spec.hexdigest == hashlib.sha256(b'deep').hexdigest()
+
+
+@pytest.fixture
+def digest_cache(monkeypatch):
+    cache = OrderedDict()
+    monkeypatch.setattr(specs, '_HEXDIGEST_CACHE', cache)
+    return cache
+
+
+def _hash_later(monkeypatch):
+    # Hashing as if 10 s from now makes just written files old enough to
+    # be cached
+    time_ns = specs._time_ns
+    monkeypatch.setattr(specs, '_time_ns', lambda: time_ns() + 10**10)
+
+
+def _count_hashing(monkeypatch):
+    calls = []
+    get_file_hexdigest = specs.get_file_hexdigest
+
+    def counted(path, *args):
+        calls.append(path)
+        return get_file_hexdigest(path, *args)
+
+    monkeypatch.setattr(specs, 'get_file_hexdigest', counted)
+    return calls
+
+
+def test_digest_cache_skips_racy_files(src_tree, digest_cache):
+    read_spec(src_tree, 'sha256')
+    assert len(digest_cache) == 0
+
+
+def test_digest_cache_reuses_digests(src_tree, digest_cache, monkeypatch):
+    _hash_later(monkeypatch)
+    spec = read_spec(src_tree, 'sha256')
+    assert len(digest_cache) == 2
+
+    calls = _count_hashing(monkeypatch)
+    assert read_spec(src_tree, 'sha256') == spec
+    assert calls == []
+
+    # A changed file gets a new stat, so is hashed again
+    (src_tree / 'a.txt').write_bytes(b'ALPHA!')
+    read_spec(src_tree, 'sha256')
+    assert len(calls) == 1
+
+
+def test_digest_cache_is_bounded(src_tree, digest_cache, monkeypatch):
+    monkeypatch.setattr(specs, '_HEXDIGEST_CACHE_SIZE', 1)
+    _hash_later(monkeypatch)
+    read_spec(src_tree, 'sha256')
+    assert len(digest_cache) == 1
+
+
+def test_check_fulfils_spec_bypasses_cache(
+        src_tree, digest_cache, monkeypatch):
+    _hash_later(monkeypatch)
+    spec = read_spec(src_tree, 'sha256')
+
+    calls = _count_hashing(monkeypatch)
+    check_fulfils_spec(src_tree, spec)
+    assert len(calls) == 2
+
+
+def test_only_large_files_get_readahead_advice(tmp_path, monkeypatch):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'small').write_bytes(b'small')
+    data = os.urandom(specs._ADVISE_THRESHOLD + 1)
+    (src / 'large').write_bytes(data)
+
+    advised = []
+    monkeypatch.setattr(specs, '_advise_sequential', advised.append)
+    spec = read_spec(src, 'sha256')
+    assert len(advised) == 1
+    assert spec.contents['large'].hexdigest == hashlib.sha256(data).hexdigest()
+
+
+def test_batch_files_by_size():
+    half = specs._BATCH_SIZE // 2
+    files = [(f'f{i}', SimpleNamespace(st_size=half)) for i in range(5)]
+    batches = specs._batch_files(files)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[0] == [('f0', half), ('f1', half)]
+
+
+def test_hash_files_in_batches(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    contents = {f'f{i}': os.urandom(i) for i in range(3 * specs._BATCH_LENGTH)}
+    for name, data in contents.items():
+        (src / name).write_bytes(data)
+
+    spec = read_spec(src, 'sha256', max_workers=4)
+    for name, data in contents.items():
+        expected = hashlib.sha256(data).hexdigest()
+        assert spec.contents[name].hexdigest == expected
+
+
+def test_batch_files_caps_length():
+    n_files = 2 * specs._BATCH_LENGTH + 1
+    files = [(f'f{i}', SimpleNamespace(st_size=0)) for i in range(n_files)]
+    batches = specs._batch_files(files)
+    lengths = [len(batch) for batch in batches]
+    assert lengths == [specs._BATCH_LENGTH, specs._BATCH_LENGTH, 1]
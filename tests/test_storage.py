@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `archivo.storage`."""
+
+import os
+import errno
+import json
+import shutil
+
+import attr
+import pytest
+
+from archivo import storage as storage_module
+from archivo import write_json_file
+from archivo.specs import check_fulfils_spec, read_spec
+from archivo.storage import (
+    Storage,
+    CollisionError,
+    RestoreError,
+    StoreError,
+    UnsupportedStorageError,
+    )
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return Storage.create(tmp_path / 'storage')
+
+
+@pytest.fixture
+def src_tree(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'empty').mkdir()
+    (src / 'a.txt').write_bytes(b'alpha')
+    (src / 'sub' / 'b.txt').write_bytes(b'beta')
+    (src / 'sub' / 'dup.txt').write_bytes(b'alpha')
+    os.chmod(src / 'sub' / 'b.txt', 0o600)
+    return src
+
+
+@pytest.fixture
+def flat_storage_path(tmp_path, src_tree):
+    # A storage as made before the layout field, holding a.txt
+    path = tmp_path / 'flat-storage'
+    path.mkdir()
+    meta = {'created': '2019-04-01T00:00:00', 'hash_name': 'sha256'}
+    (path / '.archivo-storage').write_text(json.dumps(meta))
+    file_spec = read_spec(src_tree / 'a.txt', 'sha256')
+    (path / 'sha256').mkdir()
+    shutil.copy2(src_tree / 'a.txt', path / 'sha256' / file_spec.hexdigest)
+    return path
+
+
+@pytest.fixture
+def dst_dir(tmp_path):
+    dst = tmp_path / 'dst'
+    dst.mkdir()
+    return dst
+
+
+def _overwrite_keeping_meta(path, data):
+    # Same size and mtime, so only the digest can tell the difference
+    stat_result = os.stat(path)
+    assert len(data) == stat_result.st_size
+    with open(path, 'r+b') as f:
+        f.write(data)
+    os.utime(path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+
+
+def test_store_restore_tree(storage, src_tree, dst_dir):
+    """A stored tree is restored with contents and metadata."""
+    spec = storage.store(src_tree)
+    assert spec == read_spec(src_tree, storage.hash_name)
+
+    storage.restore(spec, dst_dir)
+    check_fulfils_spec(dst_dir / 'src', spec)
+    assert (dst_dir / 'src' / 'sub' / 'b.txt').read_bytes() == b'beta'
+    assert (dst_dir / 'src' / 'empty').is_dir()
+
+
+def test_store_restore_single_file(storage, src_tree, dst_dir):
+    spec = storage.store(src_tree / 'a.txt')
+    assert spec.name == 'a.txt'
+
+    storage.restore(spec, dst_dir, verify=True)
+    check_fulfils_spec(dst_dir / 'a.txt', spec)
+
+
+def test_store_copies_by_default(storage, src_tree, dst_dir):
+    """Editing the source after storing must not change the storage."""
+    spec = storage.store(src_tree)
+    (src_tree / 'a.txt').write_bytes(b'ALPHA')
+    os.chmod(src_tree / 'a.txt', 0o600)
+
+    storage.restore(spec, dst_dir)
+    assert (dst_dir / 'src' / 'a.txt').read_bytes() == b'alpha'
+    check_fulfils_spec(dst_dir / 'src', spec)
+
+
+def test_store_link(storage, src_tree):
+    spec = storage.store(src_tree / 'a.txt', link=True)
+    stored = storage._get_storage_path(spec)
+    assert os.stat(stored).st_ino == os.stat(src_tree / 'a.txt').st_ino
+
+
+def test_store_source_modified_while_storing(
+        storage, src_tree, monkeypatch):
+    read_spec_with_files = storage_module.read_spec_with_files
+
+    def read_then_modify(path, hash_name):
+        result = read_spec_with_files(path, hash_name)
+        (src_tree / 'a.txt').write_bytes(b'modified')
+        return result
+
+    monkeypatch.setattr(
+        storage_module, 'read_spec_with_files', read_then_modify)
+    with pytest.raises(StoreError):
+        storage.store(src_tree)
+    assert os.listdir(storage.path / '.staging') == []
+
+
+def test_restore_link(storage, src_tree, dst_dir):
+    spec = storage.store(src_tree)
+    storage.restore(spec, dst_dir, link=True)
+    check_fulfils_spec(dst_dir / 'src', spec)
+
+    file_spec = spec.contents['a.txt']
+    stored = storage._get_storage_path(file_spec)
+    restored = dst_dir / 'src' / 'a.txt'
+    assert os.stat(stored).st_ino == os.stat(restored).st_ino
+
+
+@pytest.mark.parametrize('make_name', [
+    lambda tmp_path: str(tmp_path / 'pwned'),
+    lambda tmp_path: '..',
+    lambda tmp_path: os.path.join('..', 'pwned'),
+    ])
+def test_restore_refuses_escaping_name(storage, src_tree, tmp_path,
+                                       make_name):
+    """A spec name must not point outside the restore directory."""
+    spec = storage.store(src_tree)
+    bad_name = make_name(tmp_path)
+    bad_child = attr.evolve(spec.contents['a.txt'], name=bad_name)
+    bad_spec = attr.evolve(spec, contents={bad_name: bad_child})
+
+    dst_dir = tmp_path / 'dst'
+    dst_dir.mkdir()
+    with pytest.raises(ValueError):
+        storage.restore(bad_spec, dst_dir)
+
+    assert not (tmp_path / 'pwned').exists()
+    assert not (dst_dir / 'src').exists()
+
+
+def test_restore_verify_detects_corrupt_storage(storage, src_tree, dst_dir):
+    spec = storage.store(src_tree / 'a.txt')
+    _overwrite_keeping_meta(storage._get_storage_path(spec), b'ALPHA')
+
+    # Digests are checked by default
+    with pytest.raises(RestoreError):
+        storage.restore(spec, dst_dir)
+    assert not (dst_dir / 'a.txt').exists()
+
+    # Without verification, only existence and metadata are checked
+    storage.restore(spec, dst_dir, verify=False)
+    assert (dst_dir / 'a.txt').read_bytes() == b'ALPHA'
+
+
+def test_restore_again_is_noop(storage, src_tree, dst_dir):
+    spec = storage.store(src_tree)
+    storage.restore(spec, dst_dir)
+    storage.restore(spec, dst_dir)
+    check_fulfils_spec(dst_dir / 'src', spec)
+
+
+def test_restore_collision(storage, src_tree, dst_dir):
+    spec = storage.store(src_tree / 'a.txt')
+    (dst_dir / 'a.txt').write_bytes(b'other')
+    with pytest.raises(CollisionError):
+        storage.restore(spec, dst_dir)
+
+
+def test_restore_dangling_symlink_is_collision(storage, src_tree, dst_dir):
+    spec = storage.store(src_tree / 'a.txt')
+    os.symlink(dst_dir / 'missing', dst_dir / 'a.txt')
+    with pytest.raises(CollisionError):
+        storage.restore(spec, dst_dir)
+
+
+def test_store_restore_across_file_systems(
+        storage, src_tree, dst_dir, monkeypatch):
+    """A final rename failing with EXDEV falls back to copying."""
+    rename = os.rename
+
+    def rename_within_dir_only(src, dst):
+        # The fallback renames its copies, which end in .tmp, in place
+        if not os.fspath(src).endswith('.tmp'):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', rename_within_dir_only)
+    spec = storage.store(src_tree)
+    storage.restore(spec, dst_dir)
+    monkeypatch.undo()
+
+    check_fulfils_spec(dst_dir / 'src', spec)
+    assert os.listdir(storage.path / '.staging') == []
+
+
+def test_shard_layout(storage, src_tree):
+    """Files are stored at <hash_name>/<digest[:2]>/<digest>."""
+    spec = storage.store(src_tree / 'a.txt')
+    assert storage.meta['layout'] == 2
+    hash_dir = storage.path / storage.hash_name
+    assert len(os.listdir(hash_dir)) == 256
+    stored = hash_dir / spec.hexdigest[:2] / spec.hexdigest
+    assert stored.read_bytes() == b'alpha'
+    assert storage.has_file(spec)
+
+
+def test_flat_storage_is_used_in_its_layout(
+        flat_storage_path, src_tree, dst_dir):
+    storage = Storage(flat_storage_path)
+    old_spec = read_spec(src_tree / 'a.txt', 'sha256')
+    assert storage.has_file(old_spec)
+    storage.restore(old_spec, dst_dir)
+    assert (dst_dir / 'a.txt').read_bytes() == b'alpha'
+
+    new_spec = storage.store(src_tree / 'sub' / 'b.txt')
+    stored = flat_storage_path / 'sha256' / new_spec.hexdigest
+    assert stored.read_bytes() == b'beta'
+
+    storage._load_index()
+    assert storage.has_file(old_spec)
+    assert storage.has_file(new_spec)
+
+
+def test_missing_shard_dir_is_created(storage, src_tree):
+    spec = read_spec(src_tree / 'a.txt', storage.hash_name)
+    os.rmdir(storage.path / storage.hash_name / spec.hexdigest[:2])
+    storage.store(src_tree / 'a.txt')
+    assert storage.has_file(spec)
+
+
+def test_unknown_layout_is_refused(tmp_path):
+    path = tmp_path / 'future-storage'
+    path.mkdir()
+    meta = {'created': '2030-01-01T00:00:00', 'hash_name': 'sha256',
+            'layout': 99}
+    (path / '.archivo-storage').write_text(json.dumps(meta))
+    with pytest.raises(UnsupportedStorageError):
+        Storage(path)
+
+
+def test_restore_metadata_by_path(storage, src_tree, dst_dir, monkeypatch):
+    """Where os.chmod and os.utime take no descriptors (older Windows)."""
+    monkeypatch.setattr(storage_module, '_SET_META_BY_FD', False)
+    spec = storage.store(src_tree)
+    storage.restore(spec, dst_dir)
+    check_fulfils_spec(dst_dir / 'src', spec)
+
+
+def test_storage_equality_ignores_caches(storage, src_tree):
+    other = Storage(storage.path)
+    assert other == storage
+
+    storage._load_index()
+    storage.store(src_tree)
+    assert other == storage
+
+
+def test_storage_meta_is_parsed_once(storage, monkeypatch):
+    loads = []
+    load = json.load
+
+    def counted(f):
+        loads.append(f)
+        return load(f)
+
+    monkeypatch.setattr(json, 'load', counted)
+    other = Storage(storage.path)
+    assert loads == []
+
+    # Each instance gets its own copy
+    other.meta['comment'] = 'changed'
+    assert 'comment' not in Storage(storage.path).meta
+
+
+def test_storage_meta_cache_sees_rewrites(storage):
+    meta_path = storage.path / '.archivo-storage'
+    write_json_file(dict(storage.meta, comment='rewritten'), meta_path)
+    assert Storage(storage.path).meta['comment'] == 'rewritten'
+
+
+@pytest.mark.parametrize('use_libc', [True, False])
+@pytest.mark.parametrize('by_fd', [False, True])
+def test_set_mtime_ns_keeps_atime(tmp_path, monkeypatch, use_libc, by_fd):
+    if not use_libc:
+        monkeypatch.setattr(storage_module, '_utimensat', None)
+        monkeypatch.setattr(storage_module, '_futimens', None)
+    if by_fd and os.utime not in os.supports_fd:
+        pytest.skip('os.utime takes no file descriptors here')
+
+    path = tmp_path / 'f'
+    path.write_bytes(b'f')
+    atime_ns = 1_000_000_000 * 10**9
+    mtime_ns = 1_500_000_000 * 10**9 + 123
+    os.utime(path, ns=(atime_ns, atime_ns))
+
+    if by_fd:
+        with open(path, 'rb') as f:
+            storage_module.set_mtime_ns(f.fileno(), mtime_ns)
+    else:
+        storage_module.set_mtime_ns(path, mtime_ns)
+
+    stat_result = os.stat(path)
+    assert stat_result.st_atime_ns == atime_ns
+    assert stat_result.st_mtime_ns == mtime_ns
+
+
+@pytest.mark.parametrize('setting, expect_pool', [('1', True), ('0', False)])
+def test_parallel_copy_setting(storage, src_tree, dst_dir, monkeypatch,
+                               setting, expect_pool):
+    pools = []
+    executor_class = storage_module.ThreadPoolExecutor
+
+    def counted(*args, **kwargs):
+        pools.append(kwargs)
+        return executor_class(*args, **kwargs)
+
+    monkeypatch.setenv('ARCHIVO_PARALLEL_COPY', setting)
+    monkeypatch.setattr(storage_module, 'ThreadPoolExecutor', counted)
+    spec = storage.store(src_tree)
+    storage.restore(spec, dst_dir)
+    check_fulfils_spec(dst_dir / 'src', spec)
+    assert bool(pools) == expect_pool